@@ -3,10 +3,13 @@ import warnings
 import pickle
 import time
 
+from array import array
 from tqdm import tqdm
 from functools import wraps
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Union, Callable, Any, Optional
+from typing import Dict, List, Tuple, Union, Callable, Any, Optional
 
 
 class VKError(Exception):
@@ -37,8 +40,13 @@ class Base(object):
     ]
     time = 0.33
     version = 5.131
+    retries = 5
+    # requests raises RequestException on network errors and ValueError on a broken JSON body
+    request_errors = (VKError, ConnectionResetError, requests.RequestException, ValueError)
 
     def __init__(self, username: str, password: str, **kwargs):
+        self._request_lock = Lock()
+        self._last_request_time = 0.0
         self.username = username
         self.password = password
         self.access_token = self._get_access_token(**kwargs)
@@ -63,9 +71,17 @@ class Base(object):
         request = self._get_init(**kwargs)
         return request['access_token'] if 'access_token' in request.keys() else request
 
+    def _wait_request_slot(self):
+        # Shared between threads, so concurrent loaders stay within one request per self.time
+        with self._request_lock:
+            delay = self._last_request_time + self.time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._last_request_time = time.monotonic()
+
     def api_request(self, method: str, params: Dict) -> Dict:
+        self._wait_request_slot()
         request = requests.get(f"https://api.vk.com/method/{method}", params=params).json()
-        time.sleep(self.time)
         if 'error' in request:
             error = request['error']
             raise VKError(error['error_code'], error['error_msg'])
@@ -74,6 +90,20 @@ class Base(object):
             raise NotIncreaseError()
         return response
 
+    def api_request_retry(self, method: str, params: Dict) -> Dict:
+        """
+        api_request with backoff on error 6 (Too many requests per second)
+
+        """
+        retries = max(self.retries, 1)
+        for attempt in range(retries):
+            try:
+                return self.api_request(method, params)
+            except VKError as e:
+                if e.code != 6 or attempt == retries - 1:
+                    raise
+                time.sleep(self.time * 2 ** attempt)
+
     @staticmethod
     def add_base_params(**params):
         def decorator(func) -> Callable:
@@ -380,7 +410,7 @@ class Likes(Base):
 
         Parameters
         ----------
-        Likes count2load. By default, 0.
+        Likes count2load. By default, 0 — all likes (count from the response).
         count2load: int
 
         The type of the object. Possible types:
@@ -411,7 +441,7 @@ class Likes(Base):
         • 1 — return extended information about users and communities from the list
          of those who have marked "Like" or shared an entry.
         • 0 — return only user and community IDs.
-        By default, 1.
+        By default, 1. With extended=1 API returns at most 100 items, so count is limited to 100.
         extended: int (checkbox)
 
 
@@ -423,10 +453,12 @@ class Likes(Base):
 
         data = {
             'count2load': count2load,
-            'loaded_count': -1,
+            'loaded_count': 0,
             'items': []
         }
-        while data['loaded_count'] < data['count2load']:
+        if params['extended']:
+            params['count'] = min(params['count'], 100)
+        while True:
             try:
                 curr_data = self.api_request("likes.getList", params)
             except NotIncreaseError:
@@ -434,6 +466,88 @@ class Likes(Base):
             data['items'].extend(curr_data['items'])
             data['loaded_count'] += len(curr_data['items'])
             params['offset'] += params['count']
+            if data['loaded_count'] >= (data['count2load'] or curr_data['count']):
+                return data
+
+    def _get_likes_page(self, params: Dict) -> Optional[List[int]]:
+        try:
+            return self.api_request_retry("likes.getList", params)['items']
+        except NotIncreaseError:
+            return []
+        except self.request_errors as e:
+            print(f'{e}')
+            return None
+
+    @Base.add_base_params(type='post', count=1000, extended=0)
+    def get_likes_matrix(self, posts: List[Dict], max_workers: int = 3, **params) -> Dict[str, Any]:
+        """
+        Builds a sparse post x user likes matrix for a list of posts.
+        Pages of likes.getList are requested concurrently, number of pages is taken from likes.count of each post,
+        posts without likes are not requested. Only user IDs are loaded (extended is always 0).
+        https://dev.vk.com/method/likes.getList
+
+        Example: vk.get_likes_matrix(posts=data['items'])
+
+        Parameters
+        ----------
+        Posts from wall.get or wall.getById (owner_id, id and likes.count are required).
+        Keyword only, like all params.
+        posts: List[Dict]
+
+        Number of concurrent requests. All threads share one request rate limit (one request per self.time),
+        error 6 (Too many requests per second) is retried with backoff.
+        max_workers: int (positive)
+
+        Additional params:
+
+        The type of the object. By default, 'post'.
+        type: str
+
+        Returns
+        -------
+        Matrix in CSR format: likers of row i are users[indices[indptr[i]:indptr[i + 1]]].
+        • posts — (owner_id, post_id) for each row, in the order of input posts;
+        • users — user ID for each column;
+        • indptr, indices — CSR arrays (array.array, can be wrapped with numpy.frombuffer),
+          column indices are sorted within each row;
+        • failed — (row, offset) of pages which failed with an API or connection error.
+        data: Dict[str, Any]
+
+        """
+        params['extended'] = 0
+        pages = [
+            (row, params | {'owner_id': post['owner_id'], 'item_id': post['id'], 'offset': offset})
+            for row, post in enumerate(posts)
+            for offset in range(0, post.get('likes', {}).get('count', 0), params['count'])
+        ]
+        data = {
+            'total_count': sum(post.get('likes', {}).get('count', 0) for post in posts),
+            'loaded_count': 0,
+            'posts': [(post['owner_id'], post['id']) for post in posts],
+            'users': array('q'),
+            'indptr': array('q', [0]),
+            'indices': array('q'),
+            'failed': []
+        }
+        rows = [set() for _ in posts]
+        pbar = tqdm(total=len(pages), position=0, leave=True)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for (row, page), items in zip(pages, executor.map(self._get_likes_page, [page for _, page in pages])):
+                if items is None:
+                    data['failed'].append((row, page['offset']))
+                else:
+                    rows[row].update(items)
+                pbar.update(1)
+        pbar.close()
+        columns = {}
+        for likers in rows:
+            for user_id in sorted(likers):
+                if user_id not in columns:
+                    columns[user_id] = len(data['users'])
+                    data['users'].append(user_id)
+            data['indices'].extend(sorted(columns[user_id] for user_id in likers))
+            data['indptr'].append(len(data['indices']))
+        data['loaded_count'] = len(data['indices'])
         return data
 
 
@@ -442,6 +556,8 @@ class User(Wall, Likes):
     Парсинг данных пользователей ВК
 
     """
+    search_age_range = (14, 80)
+    search_limit = 1000
 
     def __init__(self, username: str, password: str, **kwargs):
         super().__init__(username, password, **kwargs)
@@ -454,6 +570,138 @@ class User(Wall, Likes):
         """
         return self.api_request("users.search", params)
 
+    def _load_search_pages(self, params: Dict, curr_data: Dict[str, Any]):
+        for offset in range(params['count'], min(curr_data['count'], self.search_limit), params['count']):
+            try:
+                curr_data['items'].extend(self.api_request_retry("users.search", params | {'offset': offset})['items'])
+            except NotIncreaseError:
+                break
+
+    def _search_partition(self, params: Dict, partition: Dict,
+                          cities: Optional[List[int]]) -> Optional[Tuple[Dict[str, Any], Optional[List[Dict]], bool]]:
+        """
+        Loads the partition and returns (data, child partitions or None, pagination failed)
+
+        """
+        try:
+            curr_data = self.api_request_retry("users.search", params)
+        except NotIncreaseError:
+            return {'count': 0, 'items': []}, None, False
+        except self.request_errors as e:
+            print(f'{e}')
+            return None
+        children = None
+        if curr_data['count'] > self.search_limit:
+            children = self._split_search_partition(params, partition, cities)
+        if children is None:
+            try:
+                self._load_search_pages(params, curr_data)
+            except self.request_errors as e:
+                print(f'{e}')
+                return curr_data, None, True
+        return curr_data, children, False
+
+    def _split_search_partition(self, query: Dict, partition: Dict,
+                                cities: Optional[List[int]]) -> Optional[List[Dict]]:
+        if cities and 'city' not in query:
+            return [partition | {'city': city} for city in cities]
+        if 'sex' not in query:
+            return [partition | {'sex': sex} for sex in (1, 2)]
+        age_from = query.get('age_from', self.search_age_range[0])
+        age_to = query.get('age_to', self.search_age_range[1])
+        if age_from < age_to:
+            middle = (age_from + age_to) // 2
+            return [
+                partition | {'age_from': age_from, 'age_to': middle},
+                partition | {'age_from': middle + 1, 'age_to': age_to},
+            ]
+        if 'birth_month' not in query:
+            return [partition | {'birth_month': month} for month in range(1, 13)]
+        if 'birth_day' not in query:
+            return [partition | {'birth_day': day} for day in range(1, 32)]
+        return None
+
+    @Base.add_base_params(count=1000, offset=0, fields=', '.join(Base.base_user_fields))
+    def crawl_users(self, cities: List[int] = None, max_workers: int = 3, **params) -> Dict[str, Any]:
+        """
+        Collect all users.search results bypassing the 1000 results limit.
+        Query is recursively partitioned by facets (city, sex, age range, birth month, birth day)
+        until each partition is under the limit. Partitions of the same level are loaded concurrently,
+        users from the first page of split partitions are kept.
+        https://dev.vk.com/method/users.search
+
+        Parameters
+        ----------
+        City IDs to partition by first. If None, city facet is skipped.
+        cities: List[int]
+
+        Number of concurrent requests. All threads share one request rate limit (one request per self.time),
+        error 6 (Too many requests per second) is retried with backoff.
+        max_workers: int (positive)
+
+        Additional params:
+
+        Any users.search params (q, country, city, sex, age_from, age_to, group_id, ...).
+        Facets already fixed in params are not split further.
+
+        Page size. Partitions under the limit are loaded with offset pages of this size. Default: 1000.
+        count: int (positive)
+
+        Returns
+        -------
+        Users data. Users without filled facet (hidden age, birth date, etc.) are lost after splitting by it,
+        so compare loaded_count with total_count to estimate coverage.
+        Partitions which are still over the limit after all facets are listed in truncated,
+        partitions which failed with an API or connection error are listed in failed.
+        data : Dict[str, Any]
+
+        """
+        data = {
+            'total_count': 0,
+            'loaded_count': 0,
+            'coverage': 0.0,
+            'partitions': 0,
+            'truncated': [],
+            'failed': [],
+            'items': []
+        }
+        seen = set()
+        partitions = [{}]
+        pbar = tqdm(position=0, leave=True)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while partitions:
+                responses = executor.map(
+                    lambda partition: self._search_partition(params | partition, partition, cities), partitions
+                )
+                next_partitions = []
+                for partition, response in zip(partitions, responses):
+                    if response is None:
+                        data['failed'].append(partition)
+                        continue
+                    curr_data, children, failed = response
+                    if not partition:
+                        data['total_count'] = curr_data['count']
+                        pbar.reset(total=curr_data['count'])
+                    for user in curr_data['items']:
+                        if user['id'] not in seen:
+                            seen.add(user['id'])
+                            data['items'].append(user)
+                    pbar.update(len(data['items']) - data['loaded_count'])
+                    data['loaded_count'] = len(data['items'])
+                    if failed:
+                        data['failed'].append(partition)
+                    if children is not None:
+                        next_partitions.extend(children)
+                        continue
+                    if curr_data['count'] > self.search_limit:
+                        data['truncated'].append(partition)
+                    data['partitions'] += 1
+                partitions = next_partitions
+        pbar.close()
+        if data['total_count']:
+            data['coverage'] = data['loaded_count'] / data['total_count']
+        return data
+
     @Base.add_base_params(fields=', '.join(Base.base_user_fields))
     def get_page_data(self, **params) -> Dict:
         """